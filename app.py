@@ -1,27 +1,89 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application
 from tornado.httpserver import HTTPServer
+from tornado.gen import coroutine, Task
+from tornado.log import app_log, access_log
 from tornado import options
-from settings import settings, db_pool_settings
+from settings import settings, db_settings, db_pool_settings, subscribe_pool_settings, session_settings, \
+    production_settings, history_cache_settings, id_settings, loop_monitor_settings, write_behind_settings
+from redis_repository import SessionRepository
+from static_assets import AssetHandler
+from history_cache import HistoryCache
+from redis_pool import ConnectionPool
+from id_generator import id_generator
+from loop_monitor import LoopLagMonitor
+from write_behind import MessageWriteQueue
+from worker_lease import WorkerLease
 from url import urls
 import tornadoredis
 import time
 import signal
+import sys
 
 
 options.define("port", default=8888, help="http server port", type=int)
+options.define("worker_id", default=id_settings['worker_id'],
+               help="unique id of this process among all chat processes (0-30)", type=int)
+options.define("production", default=False, help="disable debug mode and serve fingerprinted, "
+                                                 "precompressed static files", type=bool)
 
 
 class Chat(Application):
-    def __init__(self):
-        super(Chat, self).__init__(urls, **settings)
-        self.connection_pool = tornadoredis.ConnectionPool(**db_pool_settings)
+    def __init__(self, production=False):
+        app_settings = dict(settings)
+        if production:
+            app_settings.update(production_settings)
+            app_settings['static_handler_class'] = AssetHandler
+            AssetHandler.build_manifest(app_settings['static_path'])
+        super(Chat, self).__init__(urls, **app_settings)
+        self.connection_pool = ConnectionPool('command', **dict(db_pool_settings, **db_settings))
+        self.subscribe_pool = ConnectionPool('subscribe', **dict(subscribe_pool_settings, **db_settings))
+        self.session_sweeper = PeriodicCallback(self.sweep_sessions,
+                                                session_settings['sweep_interval'] * 1000)
+        self.history_cache = HistoryCache(**history_cache_settings)
+        self.history_cache_sweeper = PeriodicCallback(self.history_cache.evict_idle,
+                                                      history_cache_settings['idle_timeout'] * 1000 / 4)
+        self.loop_monitor = LoopLagMonitor(**loop_monitor_settings)
+        self.write_queue = None
+        if write_behind_settings['enabled']:
+            self.write_queue = MessageWriteQueue(self.get_db_connection, write_behind_settings['max_size'],
+                                                 write_behind_settings['flush_size'],
+                                                 write_behind_settings['flush_interval'])
 
+    def log_request(self, handler):
+        trace = getattr(handler, 'redis_trace', None)
+        if trace is None or 'log_function' in self.settings:
+            super(Chat, self).log_request(handler)
+            return
+        if handler.get_status() < 400:
+            log_method = access_log.info
+        elif handler.get_status() < 500:
+            log_method = access_log.warning
+        else:
+            log_method = access_log.error
+        request_time = 1000.0 * handler.request.request_time()
+        log_method("%d %s %.2fms %s", handler.get_status(),
+                   handler._request_summary(), request_time, trace.summary())
 
-def make_safely_shutdown(server, timeout=5):
+    def get_db_connection(self):
+        return tornadoredis.Client(connection_pool=self.connection_pool, **db_settings)
+
+    @coroutine
+    def sweep_sessions(self):
+        db_connection = self.get_db_connection()
+        session_repo = SessionRepository(db_connection)
+        try:
+            swept = yield session_repo.sweep_expired(session_settings['sweep_batch'])
+            if swept:
+                app_log.info('Swept %d expired sessions', swept)
+        finally:
+            yield Task(db_connection.disconnect)
+
+
+def make_safely_shutdown(server, timeout=5, write_queue=None, worker_lease=None):
     io_loop = IOLoop.instance()
 
     def stop_handler(*args, **keywords):
@@ -29,22 +91,46 @@ def make_safely_shutdown(server, timeout=5):
             server.stop()
             deadline = time.time() + timeout
 
+            @coroutine
             def stop_loop():
                 now = time.time()
                 if now < deadline:
                     io_loop.add_timeout(now + 1, stop_loop)
                 else:
+                    if write_queue is not None:
+                        yield write_queue.drain()
+                    if worker_lease is not None:
+                        yield worker_lease.release()
                     io_loop.stop()
             stop_loop()
         io_loop.add_callback(shutdown)
     signal.signal(signal.SIGTERM, stop_handler)
     signal.signal(signal.SIGINT, stop_handler)
+    return stop_handler
 
 
 if __name__ == "__main__":
     options.parse_command_line()
-    app = Chat()
+    id_generator.set_worker_id(options.options.worker_id)
+    app = Chat(production=options.options.production)
+    worker_lease = WorkerLease(app.get_db_connection, options.options.worker_id,
+                               id_settings['lease_ttl'], id_settings['lease_refresh_interval'])
+    if not IOLoop.current().run_sync(worker_lease.acquire):
+        app_log.error('Worker id %d is already in use by %s, start with another --worker_id',
+                      options.options.worker_id, worker_lease.holder)
+        sys.exit(1)
+    app.session_sweeper.start()
+    app.history_cache_sweeper.start()
+    app.loop_monitor.start()
+    if app.write_queue is not None:
+        app.write_queue.start()
     server = HTTPServer(app)
     server.listen(options.options.port)
-    make_safely_shutdown(server, timeout=1)
+    stop_handler = make_safely_shutdown(server, timeout=1, write_queue=app.write_queue,
+                                        worker_lease=worker_lease)
+
+    def on_worker_id_lost():
+        id_generator.release_worker_id()
+        stop_handler()
+    worker_lease.start(on_lost=on_worker_id_lost)
     IOLoop.current().start()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Redis round trips, commands and throughput of the repository operations.
+
+Every operation is run against channels holding each of the given numbers of
+messages and members. Commands are counted by the same tracing client the
+handlers use, a pipeline counting as one round trip. By default the repositories talk to an in-memory
+stand-in for Redis, which keeps round-trip counts exact and throughput free
+of network noise; --redis runs against the local Redis server instead (the
+selected database is flushed).
+
+Exits with status 1 when an operation needs more round trips than declared
+in BUDGETS, or when its throughput drops more than --threshold below the
+baseline stored with --save-baseline.
+
+Usage:
+    python benchmarks/bench_repositories.py [--sizes 10,100,1000] [--iterations 50]
+        [--redis [--db 15]] [--baseline FILE] [--save-baseline] [--threshold 0.25]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tornado.gen import coroutine, Task
+from tornado.ioloop import IOLoop
+from tornadoredis.client import CmdLine
+from redis_repository import UserRepository, SessionRepository, ChannelRepository, \
+    MessageRepository, ChannelUserRepository
+from redis_trace import RequestTrace, TracedClient, TracedPipeline, traced_callback, command_key
+from redis_mapper import SAVE_UNIQUE_SCRIPT, SAVE_SESSION_SCRIPT
+from models import User, Session, Channel, Message, ChannelUser
+from settings import db_settings
+from time import time
+import tornadoredis
+import argparse
+import fnmatch
+import json
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_repositories.json')
+
+# Round trips one call of the operation may take, whatever the data size.
+BUDGETS = {
+    'user.save': 1,
+    'user.filter': 2,
+    'user.get_many': 1,
+    'user.get_names': 1,
+    'session.save': 1,
+    'session.filter': 2,
+    'channel.save': 1,
+    'channel.filter': 2,
+    'message.save': 3,
+    'message.save_many': 1,
+    'message.filter': 2,
+    'message.get_ids': 1,
+    'message.get_last_ids': 1,
+    'message.get_many': 1,
+    'channel_user.save': 3,
+    'channel_user.filter': 5,
+    'channel_user.get_member_ids': 1,
+}
+
+
+class MemoryStore(object):
+    """
+    Minimal in-memory Redis answering with the raw replies Redis would send,
+    for the commands and Lua scripts the mappers use.
+    """
+
+    def __init__(self):
+        super(MemoryStore, self).__init__()
+        self.data = {}
+
+    def execute(self, cmd, *args):
+        method = 'delete' if cmd == 'DEL' else cmd.lower()
+        return getattr(self, method)(*[str(a) for a in args])
+
+    def _hash(self, key):
+        return self.data.setdefault(key, {})
+
+    def _zset(self, key):
+        return self.data.setdefault(key, {})
+
+    def _set(self, key):
+        return self.data.setdefault(key, set())
+
+    def flushdb(self):
+        self.data.clear()
+        return 'OK'
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def getset(self, key, value):
+        old, self.data[key] = self.data.get(key), value
+        return old
+
+    def setnx(self, key, value):
+        if key in self.data:
+            return 0
+        self.data[key] = value
+        return 1
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def expireat(self, key, timestamp):
+        return int(key in self.data)
+
+    def publish(self, channel, message):
+        return 0
+
+    def hmset(self, key, *items):
+        self._hash(key).update(zip(items[::2], items[1::2]))
+        return 'OK'
+
+    def hset(self, key, field, value):
+        created = field not in self._hash(key)
+        self._hash(key)[field] = value
+        return int(created)
+
+    def hsetnx(self, key, field, value):
+        if field in self._hash(key):
+            return 0
+        self._hash(key)[field] = value
+        return 1
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return [i for pair in self.data.get(key, {}).items() for i in pair]
+
+    def hdel(self, key, *fields):
+        return sum(1 for field in fields if self._hash(key).pop(field, None) is not None)
+
+    def hincrby(self, key, field, amount):
+        value = int(self._hash(key).get(field, 0)) + int(amount)
+        self._hash(key)[field] = str(value)
+        return value
+
+    def sadd(self, key, *members):
+        members = set(members) - self._set(key)
+        self._set(key).update(members)
+        return len(members)
+
+    def srem(self, key, *members):
+        members = set(members) & self._set(key)
+        self._set(key).difference_update(members)
+        return len(members)
+
+    def smembers(self, key):
+        return list(self.data.get(key, ()))
+
+    def zadd(self, key, *score_members):
+        zset = self._zset(key)
+        created = 0
+        for score, member in zip(score_members[::2], score_members[1::2]):
+            created += member not in zset
+            zset[member] = float(score)
+        return created
+
+    def zrem(self, key, *members):
+        return sum(1 for member in members if self._zset(key).pop(member, None) is not None)
+
+    def _sorted(self, key):
+        return sorted(self.data.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def _reply(self, entries, with_scores):
+        if not with_scores:
+            return [member for member, score in entries]
+        return [i for member, score in entries for i in (member, repr(score))]
+
+    def zrange(self, key, start, stop, *options):
+        entries = self._sorted(key)
+        stop = int(stop)
+        entries = entries[int(start):None if stop == -1 else stop + 1]
+        return self._reply(entries, 'WITHSCORES' in options)
+
+    def zrangebyscore(self, key, low, high, *options):
+        def bound(value):
+            exclusive = value.startswith('(')
+            return float(value.lstrip('(')), exclusive
+        (low, low_exclusive), (high, high_exclusive) = bound(low), bound(high)
+        entries = [(member, score) for member, score in self._sorted(key)
+                   if (score > low if low_exclusive else score >= low) and
+                   (score < high if high_exclusive else score <= high)]
+        if 'LIMIT' in options:
+            offset = int(options[options.index('LIMIT') + 1])
+            count = int(options[options.index('LIMIT') + 2])
+            entries = entries[offset:offset + count]
+        return self._reply(entries, 'WITHSCORES' in options)
+
+    def zinterstore(self, dest, numkeys, *keys):
+        zsets = [self.data.get(key, {}) for key in keys[:int(numkeys)]]
+        members = set(zsets[0]).intersection(*zsets[1:])
+        self.data[dest] = {member: sum(zset[member] for zset in zsets) for member in members}
+        return len(members)
+
+    def eval(self, script, numkeys, *args):
+        keys, argv = args[:int(numkeys)], args[int(numkeys):]
+        if script not in (SAVE_UNIQUE_SCRIPT, SAVE_SESSION_SCRIPT):
+            raise ValueError('Unknown script')
+        if not self.hsetnx(keys[0], argv[0], argv[1]):
+            return 0
+        if script == SAVE_SESSION_SCRIPT:
+            self.hmset(keys[1], *argv[3:])
+            self.zadd(keys[2], argv[2], argv[0])
+        else:
+            self.hmset(keys[1], *argv[2:])
+        return 1
+
+    def unwatch(self):
+        return 'OK'
+
+
+class RecordingClient(TracedClient):
+    """
+    TracedClient answering commands from a MemoryStore, when one is given,
+    instead of sending them to Redis.
+    """
+
+    def __init__(self, store=None, *args, **kwargs):
+        super(RecordingClient, self).__init__(RequestTrace('benchmark'), *args, **kwargs)
+        self.store = store
+
+    def execute_command(self, cmd, *args, **kwargs):
+        if self.store is None:
+            TracedClient.execute_command(self, cmd, *args, **kwargs)
+            return
+        callback = traced_callback(self.trace, cmd, command_key(cmd, args), kwargs.get('callback'))
+        callback(self.format_reply(CmdLine(cmd, *args), self.store.execute(cmd, *args)))
+
+    def pipeline(self, transactional=False):
+        return RecordingPipeline(self.trace, tornadoredis.Client.pipeline(self, transactional), self.store)
+
+
+class RecordingPipeline(TracedPipeline):
+    def __init__(self, trace, pipeline, store):
+        super(RecordingPipeline, self).__init__(trace, pipeline)
+        self.store = store
+
+    def execute(self, callback=None):
+        if self.store is None:
+            super(RecordingPipeline, self).execute(callback)
+            return
+        callback = self.traced_callback(callback)
+        command_stack, self.pipeline.command_stack = self.pipeline.command_stack, []
+        responses = [self.store.execute(cmd_line.cmd, *cmd_line.args) for cmd_line in command_stack]
+        callback(self.pipeline.format_replies(command_stack, responses))
+
+
+class Fixture(object):
+    """
+    A channel with `size` members, each of them having posted one message.
+    Operations writing messages or members use `scratch_channel`, so the
+    sizes read back stay the same.
+    """
+
+    def __init__(self, size):
+        super(Fixture, self).__init__()
+        self.size = size
+        self.counter = 0
+        self.users = []
+        self.channel = None
+        self.scratch_channel = None
+        self.session = None
+        self.message_ids = []
+
+    def unique(self, prefix):
+        self.counter += 1
+        return '{}-{}-{}'.format(prefix, self.size, self.counter)
+
+    @coroutine
+    def populate(self, connection):
+        self.channel = yield ChannelRepository(connection).save(Channel(name=self.unique('channel')))
+        self.scratch_channel = yield ChannelRepository(connection).save(Channel(name=self.unique('channel')))
+        user_repo = UserRepository(connection)
+        channel_user_repo = ChannelUserRepository(connection)
+        messages = []
+        for i in range(self.size):
+            user = yield user_repo.save(User(name=self.unique('user'), password='password'))
+            yield channel_user_repo.save(ChannelUser(channel=self.channel, user=user))
+            messages.append(Message(id=MessageRepository(connection).mapper.get_new_id(), user=user,
+                                    channel=self.channel, text='message number {}'.format(i)))
+            self.users.append(user)
+        yield MessageRepository(connection).save_many(messages, 500)
+        self.message_ids = [m.id for m in messages]
+        self.session = yield SessionRepository(connection).save(
+            Session(user=self.users[0], expires=int(time()) + 3600))
+
+
+def operations(fixture):
+    """
+    (name, items handled per call, coroutine function taking a connection)
+    """
+    user_ids = [u.id for u in fixture.users]
+    user = fixture.users[0]
+    channel = fixture.channel
+    scratch_channel = fixture.scratch_channel
+
+    def new_messages(connection):
+        repo = MessageRepository(connection)
+        return [Message(id=repo.mapper.get_new_id(), user=user, channel=scratch_channel, text='imported')
+                for _ in range(min(fixture.size, 500))]
+
+    return [
+        ('user.save', 1, lambda c: UserRepository(c).save(
+            User(name=fixture.unique('user'), password='password'))),
+        ('user.filter', 1, lambda c: UserRepository(c).filter({'name': user.name})),
+        ('user.get_many', len(user_ids), lambda c: UserRepository(c).get_many(user_ids)),
+        ('user.get_names', len(user_ids), lambda c: UserRepository(c).get_names(user_ids)),
+        ('session.save', 1, lambda c: SessionRepository(c).save(
+            Session(user=user, expires=int(time()) + 3600))),
+        ('session.filter', 1, lambda c: SessionRepository(c).filter({'key': fixture.session.key})),
+        ('channel.save', 1, lambda c: ChannelRepository(c).save(Channel(name=fixture.unique('channel')))),
+        ('channel.filter', 1, lambda c: ChannelRepository(c).filter({'name': channel.name})),
+        ('message.save', 1, lambda c: MessageRepository(c).save(
+            Message(user=user, channel=scratch_channel, text='hello'))),
+        ('message.save_many', min(fixture.size, 500), lambda c: MessageRepository(c).save_many(
+            new_messages(c), 500)),
+        ('message.filter', None, lambda c: MessageRepository(c).filter({'channel': channel})),
+        ('message.get_ids', min(fixture.size, 100), lambda c: MessageRepository(c).get_ids(
+            {'channel': channel, 'cursor': fixture.message_ids[0] - 1, 'limit': 100})),
+        ('message.get_last_ids', min(fixture.size, 100),
+         lambda c: MessageRepository(c).get_last_ids(channel, 100)),
+        ('message.get_many', len(fixture.message_ids),
+         lambda c: MessageRepository(c).get_many(fixture.message_ids)),
+        ('channel_user.save', 1, lambda c: ChannelUserRepository(c).save(
+            ChannelUser(channel=scratch_channel, user=user))),
+        ('channel_user.filter', 1, lambda c: ChannelUserRepository(c).filter(
+            {'user': user, 'channel': channel})),
+        ('channel_user.get_member_ids', min(fixture.size, 100),
+         lambda c: ChannelUserRepository(c).get_member_ids(channel, None, 100)),
+    ]
+
+
+@coroutine
+def measure(connection, operation, iterations):
+    connection.trace = trace = RequestTrace('benchmark')
+    result = yield operation(connection)
+    round_trips, commands = len(trace.commands), trace.command_count
+    started = time()
+    for _ in range(iterations):
+        yield operation(connection)
+    elapsed = time() - started
+    return result, round_trips, commands, iterations / elapsed
+
+
+@coroutine
+def run(args):
+    store = None if args.redis else MemoryStore()
+    connection = RecordingClient(store, selected_db=args.db, **db_settings)
+    yield Task(connection.flushdb)
+    patterns = args.only.split(',') if args.only else ['*']
+    results = {}
+    print('{:>6} {:<28} {:>6} {:>8} {:>10} {:>12}'.format(
+        'size', 'operation', 'trips', 'commands', 'ops/s', 'items/s'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        fixture = Fixture(size)
+        yield fixture.populate(connection)
+        for name, items, operation in operations(fixture):
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                continue
+            result, round_trips, commands, ops = yield measure(connection, operation, args.iterations)
+            if items is None:
+                items = len(result)
+            results['{}:{}'.format(name, size)] = {
+                'round_trips': round_trips,
+                'commands': commands,
+                'ops_per_second': ops,
+            }
+            print('{:>6} {:<28} {:>6} {:>8} {:>10.0f} {:>12.0f}'.format(
+                size, name, round_trips, commands, ops, ops * items))
+    if args.redis:
+        yield Task(connection.flushdb)
+    return results
+
+
+def check(results, baseline, threshold):
+    failures = []
+    for key, result in sorted(results.items()):
+        name = key.split(':')[0]
+        if result['round_trips'] > BUDGETS[name]:
+            failures.append('{}: {} round trips, budget is {}'.format(
+                key, result['round_trips'], BUDGETS[name]))
+        expected = baseline.get(key)
+        if expected and result['ops_per_second'] < expected['ops_per_second'] * (1 - threshold):
+            failures.append('{}: {:.0f} ops/s, baseline is {:.0f} ops/s'.format(
+                key, result['ops_per_second'], expected['ops_per_second']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,100,1000')
+    parser.add_argument('--iterations', default=50, type=int)
+    parser.add_argument('--only', default=None, help='comma separated operation patterns, e.g. message.*')
+    parser.add_argument('--redis', action='store_true', help='run against the local Redis server')
+    parser.add_argument('--db', default=15, type=int, help='Redis database to use (it is flushed)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', default=0.25, type=float,
+                        help='allowed throughput drop against the baseline')
+    args = parser.parse_args()
+
+    results = IOLoop.current().run_sync(lambda: run(args))
+    backend = 'redis' if args.redis else 'memory'
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+    if args.save_baseline:
+        stored.setdefault(backend, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(args.baseline))
+
+    failures = check(results, stored.get(backend, {}), args.threshold)
+    for failure in failures:
+        print('FAIL {}'.format(failure))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
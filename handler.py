@@ -4,12 +4,20 @@
 from tornado.web import RequestHandler
 from tornado.websocket import WebSocketHandler
 from tornado.web import escape
+from tornado.log import access_log, app_log
 from tornado.gen import coroutine, Task
 from models import User, Message, Session, Channel, ChannelUser
 from redis_repository import ChannelRepository, UserRepository, \
     SessionRepository, MessageRepository, ChannelUserRepository
 from common_exception import CommonException
-from settings import db_settings
+from metrics import metrics
+from id_generator import EPOCH
+from settings import db_settings, session_settings, history_settings, members_settings, \
+    bulk_settings, metrics_settings, websocket_settings
+from redis_trace import RequestTrace, TracedClient, is_sampled
+from redis_pool import PoolTimeout
+from tornadoredis.exceptions import ConnectionError
+from time import time
 import tornadoredis
 
 
@@ -17,9 +25,9 @@ def authenticated_async(method):
     @coroutine
     def wrapper(self, *args, **kwargs):
         self._auto_finish = False
-        self.current_user = yield Task(self.get_current_user_async)
+        self.current_user = yield self.get_current_user_async()
         if not self.current_user:
-            self.redirect('/login')
+            self.reject_unauthenticated()
         else:
             result = method(self, *args, **kwargs)
             if result is not None:
@@ -29,19 +37,71 @@ def authenticated_async(method):
 
 
 class BaseHandler(RequestHandler):
+    redis_trace = None
+
+    @coroutine
+    def prepare(self):
+        loop_monitor = self.application.loop_monitor
+        shed_kind = self.shed_kind()
+        if shed_kind and loop_monitor.should_shed(shed_kind):
+            self.reject_overloaded(loop_monitor.retry_after)
+            return
+        if is_sampled():
+            self.redis_trace = RequestTrace(self._request_summary())
+
+    def shed_kind(self):
+        """
+        Which loop lag threshold rejects this request while overloaded:
+        'connect' for new WebSocket sessions, 'request' for non-essential
+        HTTP requests, None for requests that are never shed.
+        """
+        return 'request'
+
+    def reject_unauthenticated(self):
+        self.redirect('/login')
+
+    def reject_overloaded(self, retry_after):
+        self.reject_unavailable(retry_after)
+
+    def reject_unavailable(self, retry_after=1):
+        self.set_status(503)
+        self.set_header('Retry-After', retry_after)
+        self.finish()
+
+    def log_exception(self, typ, value, tb):
+        if isinstance(value, PoolTimeout):
+            app_log.warning('%s: %s', self._request_summary(), value)
+            return
+        super(BaseHandler, self).log_exception(typ, value, tb)
+
+    def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get('exc_info')
+        if exc_info and isinstance(exc_info[1], PoolTimeout):
+            self.reject_unavailable()
+            return
+        super(BaseHandler, self).write_error(status_code, **kwargs)
+
+    def on_finish(self):
+        if self.redis_trace:
+            self.redis_trace.finish(self.request.request_time())
+
     @coroutine
     def get_current_user_async(self):
-        session_key = self.get_secure_cookie('session', max_age_days=1)
+        session_key = self.get_session_key()
         if not session_key:
             return None
-        db_connection = self.get_db_connection()
-        session_key = session_key.decode('utf-8')
+        db_connection = yield self.get_db_connection()
         session_repo = SessionRepository(db_connection)
         session = yield session_repo.filter({'key': session_key})
         if not session:
             yield self.release_db_connection(db_connection)
             return None
 
+        if session_settings['sliding'] and \
+                session.needs_renewal(session_settings['renew_threshold']):
+            yield session_repo.renew(session, session_settings['ttl'])
+            self.set_session_cookie(session)
+
         user_id = session.user
         user_repo = UserRepository(db_connection)
         user = yield user_repo.get_one(user_id)
@@ -49,12 +109,61 @@ class BaseHandler(RequestHandler):
         yield self.release_db_connection(db_connection)
         return user
 
+    def get_session_key(self):
+        session_key = self.get_secure_cookie('session', max_age_days=self.session_cookie_days())
+        if not session_key:
+            return None
+        return session_key.decode('utf-8')
+
+    def set_session_cookie(self, session):
+        self.set_secure_cookie('session', session.key, expires_days=self.session_cookie_days())
+
+    @staticmethod
+    def session_cookie_days():
+        return session_settings['ttl'] / (24 * 60 * 60)
+
+    @coroutine
+    def start_session(self, db_connection, user):
+        session = Session(user=user, expires=int(time()) + session_settings['ttl'])
+        session_repo = SessionRepository(db_connection)
+        yield session_repo.save(session)
+        self.set_session_cookie(session)
+        return session
+
+    def get_bool_argument(self, name, default=False):
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        return value.lower() in ('1', 'true', 'yes', 'on')
+
     def write_json_response(self, json):
         self.write(escape.json_encode(json))
         self.finish()
 
-    def get_db_connection(self):
-        return tornadoredis.Client(connection_pool=self.application.connection_pool, **db_settings)
+    @coroutine
+    def write_json_chunk(self, json):
+        self.write(escape.json_encode(json))
+        self.write('\n')
+        yield self.flush()
+
+    @coroutine
+    def get_db_connection(self, trace=None, acquire_timeout=None):
+        trace = trace or self.redis_trace
+        connection_pool = self.application.connection_pool
+        if not trace:
+            db_connection = tornadoredis.Client(connection_pool=connection_pool, **db_settings)
+            yield connection_pool.wait_connection(db_connection, acquire_timeout)
+            return db_connection
+        started = time()
+        db_connection = TracedClient(trace, connection_pool=connection_pool, **db_settings)
+        try:
+            yield connection_pool.wait_connection(db_connection, acquire_timeout)
+        finally:
+            trace.record_pool_wait(time() - started)
+        return db_connection
+
+    def get_subscribe_connection(self):
+        return tornadoredis.Client(connection_pool=self.application.subscribe_pool, **db_settings)
 
     @coroutine
     def release_db_connection(self, db_connection):
@@ -62,6 +171,9 @@ class BaseHandler(RequestHandler):
 
 
 class ChannelHandler(BaseHandler):
+    def shed_kind(self):
+        return 'request' if self.request.method == 'GET' else None
+
     @authenticated_async
     @coroutine
     def get(self, *args, **kwargs):
@@ -74,14 +186,21 @@ class ChannelHandler(BaseHandler):
     @authenticated_async
     @coroutine
     def post(self, *args, **kwargs):
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         already_joined = True
         channel_repo = ChannelRepository(db_connection)
         channel_name = self.get_argument('channel')
         channel = yield channel_repo.filter({'name': channel_name})
         if not channel:
             channel = Channel(name=channel_name)
-            yield channel_repo.save(channel)
+            try:
+                yield channel_repo.save(channel)
+            except CommonException:
+                channel = yield channel_repo.filter({'name': channel_name})
+                if not channel:
+                    yield self.release_db_connection(db_connection)
+                    self.send_error(409, reason='Channel name is unavailable')
+                    return
         channel_user_repo = ChannelUserRepository(db_connection)
         channel_user = yield channel_user_repo.filter({'user': self.current_user, 'channel': channel})
         if not channel_user:
@@ -107,7 +226,7 @@ class ChannelHandler(BaseHandler):
         channel_id = kwargs.get('channel')
         if not channel_id:
             return None
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         channel_repo = ChannelRepository(db_connection)
         channel = yield channel_repo.get_one(channel_id)
         if not channel:
@@ -127,7 +246,7 @@ class ChannelHandler(BaseHandler):
 
     @coroutine
     def get_all_channels(self):
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         channel_user_repo = ChannelUserRepository(db_connection)
         channel_user = yield channel_user_repo.filter({'user': self.current_user})
         channel_repo = ChannelRepository(db_connection)
@@ -143,7 +262,7 @@ class ChannelHandler(BaseHandler):
 
     @coroutine
     def get_one_channel(self, channel_id):
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         channel_repo = ChannelRepository(db_connection)
         channel = yield channel_repo.get_one(channel_id)
         channel_user_repo = ChannelUserRepository(db_connection)
@@ -153,20 +272,221 @@ class ChannelHandler(BaseHandler):
             self.send_error(reason='Channel unavailable')
             return
 
+        if self.get_bool_argument('stream'):
+            yield self.stream_channel_history(db_connection, channel)
+            return
+
+        limit = self.get_argument('limit', None)
+        if limit:
+            if not limit.isdigit():
+                yield self.release_db_connection(db_connection)
+                self.send_error(400, reason='Invalid limit')
+                return
+            yield self.get_recent_history(db_connection, channel, max(1, int(limit)))
+            return
+
         message_repo = MessageRepository(db_connection)
         messages = yield message_repo.filter({'channel': channel})
         user_repo = UserRepository(db_connection)
-        users = yield user_repo.get_many(set([m.user for m in messages if m.user]))
+        users = yield user_repo.get_many(set(m.user for m in messages if m.user))
         users_dict = {u.id: u for u in users if u}
         yield self.release_db_connection(db_connection)
         for message in messages:
             message.user = users_dict.get(message.user)
-        messages = sorted(messages, key=lambda x: x.timestamp)
+        messages.sort(key=lambda m: m.id)
         self.write_json_response({
             'messages': [m.get_dict() for m in messages],
             'channel': channel.id
         })
 
+    @coroutine
+    def get_recent_history(self, db_connection, channel, limit):
+        history_cache = self.application.history_cache
+        messages = history_cache.get_recent(channel.id, limit)
+        if messages is None:
+            message_repo = MessageRepository(db_connection)
+            message_ids = yield message_repo.get_last_ids(channel, max(limit, history_cache.capacity))
+            messages = yield message_repo.get_many(message_ids)
+            messages = [m for m in messages if m]
+            user_repo = UserRepository(db_connection)
+            users = yield user_repo.get_many(set(m.user for m in messages if m.user))
+            users_dict = {u.id: u for u in users if u}
+            for message in messages:
+                message.user = users_dict.get(message.user)
+            messages = [m.get_dict() for m in messages]
+            if history_cache.is_live(channel.id):
+                history_cache.warm(channel.id, messages)
+            messages = [escape.json_encode(m) for m in messages[-limit:]]
+        yield self.release_db_connection(db_connection)
+        self.write(self.format_cached_messages(messages, channel))
+        self.finish()
+
+    @staticmethod
+    def format_cached_messages(messages, channel):
+        return '{{"messages": [{}], "channel": {}}}'.format(
+            ', '.join(messages), escape.json_encode(channel.id))
+
+    @coroutine
+    def stream_channel_history(self, db_connection, channel):
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        history_cache = self.application.history_cache
+        cached = history_cache.get_recent(channel.id, history_cache.capacity)
+        message_repo = MessageRepository(db_connection)
+        user_repo = UserRepository(db_connection)
+        batch_size = history_settings['stream_batch_size']
+        query = {'channel': channel, 'limit': batch_size}
+        if cached:
+            query['before'] = escape.json_decode(cached[0])['id']
+        recent = []
+        try:
+            while True:
+                message_ids = yield message_repo.get_ids(query)
+                if not message_ids:
+                    break
+                query['cursor'] = message_ids[-1]
+                messages = yield message_repo.get_many(message_ids)
+                messages = [m for m in messages if m]
+                users = yield user_repo.get_many(set(m.user for m in messages if m.user))
+                users_dict = {u.id: u for u in users if u}
+                for message in messages:
+                    message.user = users_dict.get(message.user)
+                messages = [m.get_dict() for m in messages]
+                yield self.write_json_chunk({'messages': messages, 'channel': channel.id})
+                if not cached:
+                    recent = (recent + messages)[-history_cache.capacity:]
+        finally:
+            yield self.release_db_connection(db_connection)
+        if cached:
+            self.write(self.format_cached_messages(cached, channel))
+            self.write('\n')
+        elif 'cursor' not in query:
+            yield self.write_json_chunk({'messages': [], 'channel': channel.id})
+        elif recent and history_cache.is_live(channel.id):
+            history_cache.warm(channel.id, recent)
+        self.finish()
+
+
+class ChannelMessagesHandler(BaseHandler):
+    """
+    Bulk import API. Errors are JSON; like every POST it needs the `_xsrf`
+    cookie echoed in an X-XSRFToken header.
+    """
+
+    def reject_unauthenticated(self):
+        self.send_error(401, reason='Authentication required')
+
+    def write_error(self, status_code, **kwargs):
+        exc_info = kwargs.get('exc_info')
+        if exc_info and isinstance(exc_info[1], PoolTimeout):
+            super(ChannelMessagesHandler, self).write_error(status_code, **kwargs)
+            return
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.finish(escape.json_encode({'status': False, 'error': self._reason}))
+
+    @authenticated_async
+    @coroutine
+    def post(self, *args, **kwargs):
+        try:
+            items = self.get_messages_argument()
+        except (ValueError, TypeError, KeyError) as e:
+            self.send_error(400, reason='Invalid messages: {}'.format(e))
+            return
+
+        db_connection = yield self.get_db_connection()
+        channel_repo = ChannelRepository(db_connection)
+        channel = yield channel_repo.get_one(kwargs.get('channel'))
+        channel_user_repo = ChannelUserRepository(db_connection)
+        channel_user = None
+        if channel:
+            channel_user = yield channel_user_repo.filter({'channel': channel, 'user': self.current_user})
+        if not channel_user:
+            yield self.release_db_connection(db_connection)
+            self.send_error(reason='Channel unavailable')
+            return
+
+        messages = [Message(user=self.current_user, channel=channel, text=text, timestamp=timestamp)
+                    for text, timestamp in items]
+        message_repo = MessageRepository(db_connection)
+        try:
+            yield message_repo.assign_backdated_ids(messages, bulk_settings['index_ttl'])
+            yield message_repo.save_many(messages, bulk_settings['chunk_size'])
+        except CommonException as e:
+            yield self.release_db_connection(db_connection)
+            self.send_error(400, reason=str(e))
+            return
+        yield message_repo.publish_import(channel, len(messages))
+        yield self.release_db_connection(db_connection)
+        self.write_json_response({'status': True, 'imported': len(messages)})
+
+    def get_messages_argument(self):
+        messages = escape.json_decode(self.request.body)['messages']
+        if not isinstance(messages, list) or not messages:
+            raise ValueError('expected a non-empty list')
+        if len(messages) > bulk_settings['max_batch']:
+            raise ValueError('at most {} messages per request'.format(bulk_settings['max_batch']))
+        now = int(time())
+        items = []
+        for message in messages:
+            text = message['text']
+            timestamp = int(message.get('timestamp') or now)
+            if not isinstance(text, str) or not text:
+                raise ValueError('empty text')
+            if not EPOCH / 1000 <= timestamp <= now:
+                raise ValueError('timestamp out of range')
+            items.append((text, timestamp))
+        return items
+
+
+class ChannelMembersHandler(BaseHandler):
+    @authenticated_async
+    @coroutine
+    def get(self, *args, **kwargs):
+        try:
+            cursor = self.get_argument('cursor', None)
+            cursor = int(cursor) if cursor else None
+            limit = int(self.get_argument('limit', members_settings['page_size']))
+        except ValueError:
+            self.send_error(400, reason='Invalid cursor or limit')
+            return
+        limit = max(1, min(limit, members_settings['max_page_size']))
+
+        db_connection = yield self.get_db_connection()
+        channel_repo = ChannelRepository(db_connection)
+        channel = yield channel_repo.get_one(kwargs.get('channel'))
+        channel_user_repo = ChannelUserRepository(db_connection)
+        channel_user = None
+        if channel:
+            channel_user = yield channel_user_repo.filter({'channel': channel, 'user': self.current_user})
+        if not channel_user:
+            yield self.release_db_connection(db_connection)
+            self.send_error(reason='Channel unavailable')
+            return
+
+        user_ids, next_cursor = yield channel_user_repo.get_member_ids(channel, cursor, limit)
+        user_repo = UserRepository(db_connection)
+        names = yield user_repo.get_names(user_ids)
+        yield self.release_db_connection(db_connection)
+        self.write_json_response({
+            'members': [{
+                'id': user_id,
+                'name': names.get(user_id),
+            }
+                for user_id in user_ids],
+            'next_cursor': next_cursor,
+            'channel': channel.id,
+        })
+
+
+class MetricsHandler(BaseHandler):
+    def shed_kind(self):
+        return None
+
+    def get(self):
+        if self.request.remote_ip not in metrics_settings['allowed_ips']:
+            self.send_error(403, reason='Forbidden')
+            return
+        self.write_json_response(metrics.snapshot())
+
 
 class ChatHandler(BaseHandler):
     @authenticated_async
@@ -180,7 +500,7 @@ class LoginHandler(BaseHandler):
 
     @coroutine
     def post(self, *args, **kwargs):
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         login, password = self.get_login_password(*args, **kwargs)
         user_repo = UserRepository(db_connection)
         user = yield user_repo.filter({'name': login})
@@ -190,10 +510,7 @@ class LoginHandler(BaseHandler):
         if not user.verify_password(password):
             self.render('login.html')
             return
-        session = Session(user=user)
-        self.set_secure_cookie('session', session.key, expires_days=1)
-        session_repo = SessionRepository(db_connection)
-        yield session_repo.save(session)
+        yield self.start_session(db_connection, user)
         yield self.release_db_connection(db_connection)
         self.redirect('/')
 
@@ -204,14 +521,16 @@ class LoginHandler(BaseHandler):
 
 
 class LogoutHandler(BaseHandler):
+    def shed_kind(self):
+        return None
+
     @authenticated_async
     @coroutine
     def get(self):
-        session_key = self.get_secure_cookie('session', max_age_days=1)
+        session_key = self.get_session_key()
         if not session_key:
             return None
-        session_key = session_key.decode('utf-8')
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         session_repo = SessionRepository(db_connection)
         session = yield session_repo.filter({'key': session_key})
         if not session:
@@ -230,22 +549,20 @@ class SignUpHandler(BaseHandler):
     @coroutine
     def post(self, *args, **kwargs):
         login, password = self.get_login_password()
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         user_repo = UserRepository(db_connection)
         user = User(name=login, password=User.new_password(password))
         try:
             yield user_repo.save(user)
         except CommonException:
+            yield self.release_db_connection(db_connection)
             self.render('sign_up.html')
             return
         if not user:
             yield self.release_db_connection(db_connection)
             self.render('sign_up.html')
             return
-        session = Session(user=user)
-        self.set_secure_cookie('session', session.key)
-        session_repo = SessionRepository(db_connection)
-        yield session_repo.save(session)
+        yield self.start_session(db_connection, user)
         yield self.release_db_connection(db_connection)
         self.redirect('/')
 
@@ -261,16 +578,35 @@ class WebSocketChannelHandler(BaseHandler, WebSocketHandler):
         self.channel = None
         self.user = None
         self.subscribed = False
-        self.subscribe_connection = self.get_db_connection()
+        self.subscribe_connection = None
+        self.overloaded = False
+
+    def shed_kind(self):
+        return 'connect'
+
+    def reject_overloaded(self, retry_after):
+        # Browsers cannot read the status of a refused upgrade, so the socket
+        # is accepted and closed with 1013 in open().
+        self.overloaded = True
 
-    @authenticated_async
     @coroutine
     def open(self, *args, **kwargs):
+        if self.overloaded:
+            self.close(code=1013, reason='Try again later')
+            return
+        try:
+            yield self.open_channel(*args, **kwargs)
+        except PoolTimeout:
+            self.close(code=1013, reason='Try again later')
+
+    @authenticated_async
+    @coroutine
+    def open_channel(self, *args, **kwargs):
         self.user = self.current_user
         if not self.user:
             self.close(reason='Unknown user')
             return
-        db_connection = self.get_db_connection()
+        db_connection = yield self.get_db_connection()
         channel_id = kwargs.get('channel')
         channel_repo = ChannelRepository(db_connection)
         self.channel = yield channel_repo.get_one(channel_id)
@@ -285,11 +621,23 @@ class WebSocketChannelHandler(BaseHandler, WebSocketHandler):
             self.close(reason='Channel unavailable')
             return
 
-        channel_name = 'sub:channel:{}'.format(self.channel.id)
-        yield Task(self.subscribe_connection.subscribe, channel_name)
-        self.subscribed = True
         yield self.release_db_connection(db_connection)
+        try:
+            self.subscribe_connection = self.get_subscribe_connection()
+        except ConnectionError:
+            metrics.incr('redis.subscribe_pool.exhausted')
+            self.close(code=1013, reason='Try again later')
+            return
+
+        channel_names = ['sub:channel:{}'.format(self.channel.id),
+                         'sub:channel:{}:imports'.format(self.channel.id)]
+        yield Task(self.subscribe_connection.subscribe, channel_names)
+        self.subscribed = True
+        self.application.history_cache.subscribe(self.channel.id)
         self.subscribe_connection.listen(callback=self.on_messages_published)
+        if self.redis_trace:
+            self.log_event_trace(self.redis_trace)
+            self.redis_trace = None
 
     @coroutine
     def on_message(self, message):
@@ -298,22 +646,45 @@ class WebSocketChannelHandler(BaseHandler, WebSocketHandler):
         if not text:
             self.send_error(reason='Empty text')
             return
-        db_connection = self.get_db_connection()
+        trace = RequestTrace('WS message {}'.format(self.request.path)) if is_sampled() else None
+        try:
+            db_connection = yield self.get_db_connection(trace, websocket_settings['message_acquire_timeout'])
+        except PoolTimeout:
+            self.write_message({'error': 'Message was not sent, try again', 'text': text})
+            return
         message = Message(user=self.user, channel=self.channel, text=text)
         message_repo = MessageRepository(db_connection)
-        yield message_repo.save(message)
+        write_queue = self.application.write_queue
+        if write_queue is None or not write_queue.enqueue(message_repo.assign_id(message)):
+            yield message_repo.save(message)
         yield message_repo.publish_message(message)
         yield self.release_db_connection(db_connection)
+        if trace:
+            self.log_event_trace(trace)
+
+    def log_event_trace(self, trace):
+        duration = time() - trace.started
+        access_log.info('%s %.2fms %s', trace.name, duration * 1000, trace.summary())
+        trace.finish(duration)
 
     @coroutine
     def on_close(self):
         if self.subscribed:
-            channel_name = 'sub:channel:{}'.format(self.channel.id)
-            yield Task(self.subscribe_connection.unsubscribe, channel_name)
+            channel_names = ['sub:channel:{}'.format(self.channel.id),
+                             'sub:channel:{}:imports'.format(self.channel.id)]
+            yield Task(self.subscribe_connection.unsubscribe, channel_names)
             self.subscribed = False
-            yield self.release_db_connection(self.subscribe_connection)
+            self.application.history_cache.unsubscribe(self.channel.id)
+        if self.subscribe_connection:
+            subscribe_connection, self.subscribe_connection = self.subscribe_connection, None
+            yield self.release_db_connection(subscribe_connection)
 
     @coroutine
     def on_messages_published(self, message):
-        if message.kind == 'message':
-            self.write_message(message.body)
+        if message.kind != 'message':
+            return
+        if message.channel.endswith(':imports'):
+            self.application.history_cache.invalidate(self.channel.id)
+        else:
+            self.application.history_cache.append(self.channel.id, message.body)
+        self.write_message(message.body)
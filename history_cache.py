@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, deque
+from tornado import escape
+from metrics import metrics
+import time
+
+
+# Rough per-entry cost of the deque slot and the set entry.
+ENTRY_OVERHEAD = 120
+
+
+class ChannelHistory(object):
+    __slots__ = ('messages', 'bodies', 'size', 'subscribers', 'warm', 'last_access')
+
+    def __init__(self):
+        super(ChannelHistory, self).__init__()
+        self.messages = deque()
+        self.bodies = set()
+        self.size = 0
+        self.subscribers = 0
+        self.warm = False
+        self.last_access = time.time()
+
+    def clear(self):
+        self.messages.clear()
+        self.bodies.clear()
+        self.size = 0
+        self.warm = False
+
+
+class HistoryCache(object):
+    """
+    Last messages of the channels this process is subscribed to.
+
+    Buffers are fed from the pub/sub messages the WebSocket handlers receive
+    and warmed from Redis on first read. A buffer is only trusted while at
+    least one local subscriber keeps it up to date. Messages are kept as the
+    JSON strings that were published, so serving them needs no encoding.
+    """
+
+    def __init__(self, capacity, memory_budget, idle_timeout):
+        super(HistoryCache, self).__init__()
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.channels = OrderedDict()
+        self.size = 0
+        metrics.register_gauge('history_cache.bytes', lambda: self.size)
+        metrics.register_gauge('history_cache.channels', lambda: len(self.channels))
+
+    def subscribe(self, channel_id):
+        channel_id = str(channel_id)
+        history = self.channels.get(channel_id)
+        if history is None:
+            history = self.channels[channel_id] = ChannelHistory()
+        history.subscribers += 1
+
+    def unsubscribe(self, channel_id):
+        channel_id = str(channel_id)
+        history = self.channels.get(channel_id)
+        if history is None:
+            return
+        history.subscribers -= 1
+        if history.subscribers <= 0:
+            self._drop(channel_id)
+
+    def is_live(self, channel_id):
+        return str(channel_id) in self.channels
+
+    def append(self, channel_id, body):
+        history = self.channels.get(str(channel_id))
+        if history is None or body in history.bodies:
+            return
+        self._push(history, body)
+        self._enforce_budget()
+
+    def get_recent(self, channel_id, limit):
+        channel_id = str(channel_id)
+        history = self.channels.get(channel_id)
+        if history is None or not history.warm or limit > self.capacity:
+            metrics.incr('history_cache.misses')
+            return None
+        metrics.incr('history_cache.hits')
+        history.last_access = time.time()
+        self.channels.move_to_end(channel_id)
+        messages = list(history.messages)
+        return messages[-limit:] if limit < len(messages) else messages
+
+    def warm(self, channel_id, messages):
+        channel_id = str(channel_id)
+        history = self.channels.get(channel_id)
+        if history is None:
+            return
+        bodies = {int(m['id']): escape.json_encode(m) for m in messages}
+        for body in history.messages:
+            bodies[int(escape.json_decode(body)['id'])] = body
+        self.size -= history.size
+        history.clear()
+        for _id in sorted(bodies)[-self.capacity:]:
+            self._push(history, bodies[_id])
+        history.warm = True
+        history.last_access = time.time()
+        self.channels.move_to_end(channel_id)
+        self._enforce_budget()
+
+    def invalidate(self, channel_id):
+        history = self.channels.get(str(channel_id))
+        if history is not None:
+            self.size -= history.size
+            history.clear()
+
+    def evict_idle(self):
+        deadline = time.time() - self.idle_timeout
+        for channel_id, history in list(self.channels.items()):
+            if history.messages and history.last_access < deadline:
+                self.invalidate(channel_id)
+                metrics.incr('history_cache.evictions.idle')
+
+    def _push(self, history, body):
+        if len(history.messages) >= self.capacity:
+            oldest = history.messages.popleft()
+            history.bodies.discard(oldest)
+            history.size -= len(oldest) + ENTRY_OVERHEAD
+            self.size -= len(oldest) + ENTRY_OVERHEAD
+        history.messages.append(body)
+        history.bodies.add(body)
+        history.size += len(body) + ENTRY_OVERHEAD
+        self.size += len(body) + ENTRY_OVERHEAD
+
+    def _drop(self, channel_id):
+        history = self.channels.pop(channel_id)
+        self.size -= history.size
+
+    def _enforce_budget(self):
+        for channel_id in list(self.channels):
+            if self.size <= self.memory_budget:
+                return
+            if self.channels[channel_id].messages:
+                self.invalidate(channel_id)
+                metrics.incr('history_cache.evictions.memory')
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from common_exception import CommonException
+from settings import id_settings
+import time
+
+
+# Ids have to survive JSON.parse in chat.js, so they are kept within 53 bits:
+# 41 bits of milliseconds since EPOCH, 5 bits of worker id, 7 bits of sequence.
+EPOCH = 1500000000000
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+# Reserved for ids of imported messages, see backdated_id().
+IMPORT_WORKER_ID = MAX_WORKER_ID
+MAX_BACKDATED_PER_SECOND = 1000 * (SEQUENCE_MASK + 1)
+
+
+def make_id(timestamp, worker_id, sequence):
+    return (timestamp << (WORKER_BITS + SEQUENCE_BITS)) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def backdated_id(timestamp, index):
+    """
+    Id for the index-th message imported with the given unix timestamp
+    (seconds). The caller is responsible for never reusing an index for the
+    same second; ids sort by timestamp, then by index.
+    """
+    if not 0 <= index < MAX_BACKDATED_PER_SECOND:
+        raise CommonException('Too many messages imported for one second')
+    millis = timestamp * 1000 + index // (SEQUENCE_MASK + 1) - EPOCH
+    if millis < 0:
+        raise CommonException('Timestamp is older than the id epoch')
+    return make_id(millis, IMPORT_WORKER_ID, index & SEQUENCE_MASK)
+
+
+class IdGenerator(object):
+    """
+    Snowflake-style generator of unique, creation-ordered ids.
+
+    Uniqueness across processes relies on every process using its own
+    worker id. If the clock goes backwards, or more than 128 ids are needed
+    within one millisecond, ids continue from the last timestamp handed out
+    instead of blocking the IOLoop.
+    """
+
+    def __init__(self, worker_id=0):
+        super(IdGenerator, self).__init__()
+        self.worker_id = None
+        self.last_timestamp = -1
+        self.sequence = 0
+        self.set_worker_id(worker_id)
+
+    def set_worker_id(self, worker_id):
+        if not 0 <= worker_id < IMPORT_WORKER_ID:
+            raise CommonException('Worker id must be between 0 and {}'.format(IMPORT_WORKER_ID - 1))
+        self.worker_id = worker_id
+
+    def release_worker_id(self):
+        self.worker_id = None
+
+    def next_id(self):
+        if self.worker_id is None:
+            raise CommonException('No worker id held by this process')
+        timestamp = int(time.time() * 1000) - EPOCH
+        if timestamp <= self.last_timestamp:
+            timestamp = self.last_timestamp
+            self.sequence = (self.sequence + 1) & SEQUENCE_MASK
+            if self.sequence == 0:
+                timestamp += 1
+        else:
+            self.sequence = 0
+        self.last_timestamp = timestamp
+        return make_id(timestamp, self.worker_id, self.sequence)
+
+
+id_generator = IdGenerator(id_settings['worker_id'])
+
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from tornado.ioloop import IOLoop
+from metrics import metrics
+
+
+class LoopLagMonitor(object):
+    """
+    Measures how late the IOLoop runs a callback scheduled every `interval`
+    seconds and decides whether new work should be shed.
+
+    The reported lag follows spikes immediately and decays by half per sample.
+    Work is shed only once `shed_samples` consecutive samples were late by
+    more than the threshold, so a single slow iteration (a bcrypt hash, say)
+    does not trip it.
+    """
+
+    def __init__(self, interval, shed_connect_lag, shed_request_lag, shed_samples, retry_after):
+        super(LoopLagMonitor, self).__init__()
+        self.interval = interval
+        self.thresholds = {
+            'connect': shed_connect_lag,
+            'request': shed_request_lag,
+        }
+        self.shed_samples = shed_samples
+        self.retry_after = retry_after
+        self.late_samples = {kind: 0 for kind in self.thresholds}
+        self.lag = 0.0
+        self.expected = None
+        self.io_loop = None
+        metrics.register_gauge('loop.lag_ms', lambda: round(self.lag * 1000, 2))
+
+    def start(self):
+        self.io_loop = IOLoop.current()
+        self._schedule()
+
+    def _schedule(self):
+        self.expected = self.io_loop.time() + self.interval
+        self.io_loop.call_at(self.expected, self._sample)
+
+    def _sample(self):
+        lag = max(0.0, self.io_loop.time() - self.expected)
+        self.lag = max(lag, self.lag / 2)
+        for kind, threshold in self.thresholds.items():
+            self.late_samples[kind] = self.late_samples[kind] + 1 if lag > threshold else 0
+        self._schedule()
+
+    def should_shed(self, kind):
+        if self.late_samples[kind] < self.shed_samples:
+            return False
+        metrics.incr('loop.shed.{}'.format(kind))
+        return True
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+
+class Metrics(object):
+    def __init__(self):
+        super(Metrics, self).__init__()
+        self.counters = defaultdict(int)
+        self.gauges = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+    def register_gauge(self, name, getter):
+        self.gauges[name] = getter
+
+    def snapshot(self):
+        result = dict(self.counters)
+        for name, getter in self.gauges.items():
+            result[name] = getter()
+        return result
+
+
+metrics = Metrics()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Converts the channel:<id>:messages indexes written as plain sets into sorted
+sets scored by message id, the layout MessageMapper reads and writes.
+
+Run it once with the chat servers stopped: a server still writing the old
+layout would fail on the converted keys. Keys that are already sorted sets
+are skipped, so the script can be re-run after an interruption.
+
+Usage:
+    python migrate_channel_messages.py [--batch 1000]
+"""
+
+from tornado.gen import coroutine, Task
+from tornado.ioloop import IOLoop
+from settings import db_settings
+import tornadoredis
+import argparse
+
+
+# Replaces the set KEYS[1] by a sorted set of the same members scored by
+# their value. Returns the number of members, or -1 if KEYS[1] is not a set.
+CONVERT_SCRIPT = """
+if redis.call('TYPE', KEYS[1]).ok ~= 'set' then
+    return -1
+end
+local ids = redis.call('SMEMBERS', KEYS[1])
+redis.call('DEL', KEYS[1])
+for start = 1, #ids, 1000 do
+    local args = {}
+    for i = start, math.min(start + 999, #ids) do
+        args[#args + 1] = ids[i]
+        args[#args + 1] = ids[i]
+    end
+    redis.call('ZADD', KEYS[1], unpack(args))
+end
+return #ids
+"""
+
+
+@coroutine
+def migrate(connection, batch):
+    cursor, keys_converted, messages = 0, 0, 0
+    while True:
+        cursor, keys = yield Task(connection.scan, cursor, count=batch, match='channel:*:messages')
+        for key in keys:
+            count = yield Task(connection.eval, CONVERT_SCRIPT, keys=[key])
+            if count >= 0:
+                keys_converted += 1
+                messages += count
+        if not cursor:
+            return keys_converted, messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch', type=int, default=1000, help='keys per SCAN call')
+    args = parser.parse_args()
+    connection = tornadoredis.Client(**db_settings)
+    keys_converted, messages = IOLoop.current().run_sync(lambda: migrate(connection, args.batch))
+    print('{} channels converted, {} messages indexed'.format(keys_converted, messages))
+
+
+if __name__ == '__main__':
+    main()
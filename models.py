@@ -11,6 +11,8 @@ from time import time
 
 
 class BaseModel(object):
+    __slots__ = ('id', )
+
     def __init__(self, id):
         super(BaseModel, self).__init__()
         self.id = id
@@ -20,6 +22,8 @@ class BaseModel(object):
 
 
 class User(BaseModel):
+    __slots__ = ('name', 'password', 'admin', 'session', 'channels')
+
     def __init__(self, id=None, name=None, password=None,
                  admin=False, session=None, channels=None):
         super(User, self).__init__(id)
@@ -38,6 +42,8 @@ class User(BaseModel):
 
 
 class Channel(BaseModel):
+    __slots__ = ('name', 'users', 'messages')
+
     def __init__(self, id=None, name=None, users=None, messages=None):
         super(Channel, self).__init__(id)
         self.name = name
@@ -57,13 +63,24 @@ class Channel(BaseModel):
 
 
 class Message(BaseModel):
+    __slots__ = ('user', 'channel', 'text', 'timestamp')
+
     def __init__(self, id=None, user=None, channel=None, text=None, timestamp=None):
         super(Message, self).__init__(id)
         self.user = user
         self.channel = channel
         self.text = text
-        self.timestamp = timestamp if timestamp \
-            else datetime_to_timestamp(datetime.utcnow())
+        self.timestamp = timestamp if timestamp else int(time())
+
+    @classmethod
+    def from_values(cls, id, user, channel, text, timestamp):
+        message = cls.__new__(cls)
+        message.id = id
+        message.user = user
+        message.channel = channel
+        message.text = text
+        message.timestamp = timestamp
+        return message
 
     def get_dict(self):
         return {
@@ -75,6 +92,8 @@ class Message(BaseModel):
 
 
 class Session(BaseModel):
+    __slots__ = ('user', 'key', 'expires', 'timezone')
+
     def __init__(self, id=None, user=None, key=None, expires=None, timezone=0):
         super(Session, self).__init__(id)
         self.user = user
@@ -83,6 +102,18 @@ class Session(BaseModel):
             else datetime_to_timestamp(datetime.utcnow() + timedelta(days=1))
         self.timezone = timezone
 
+    def is_expired(self, now=None):
+        now = now if now is not None else int(time())
+        return self.expires <= now
+
+    def needs_renewal(self, threshold, now=None):
+        now = now if now is not None else int(time())
+        return self.expires - now < threshold
+
+    def renew(self, ttl, now=None):
+        now = now if now is not None else int(time())
+        self.expires = now + ttl
+
     def generate_session(self):
         parts = [
             str(urandom(128)),
@@ -94,14 +125,15 @@ class Session(BaseModel):
 
 
 class ChannelUser(BaseModel):
+    __slots__ = ('channel', 'user', 'admin', 'subscribed')
+
     def __init__(self, id=None, channel=None, user=None,
                  admin=False, subscribed=None):
         super(ChannelUser, self).__init__(id)
         self.channel = channel
         self.user = user
         self.admin = admin
-        self.subscribed = subscribed if subscribed \
-            else datetime_to_timestamp(datetime.utcnow())
+        self.subscribed = subscribed if subscribed else int(time())
 
 
 def datetime_to_timestamp(dt):
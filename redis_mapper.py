@@ -3,6 +3,59 @@
 
 from tornado.gen import Task, coroutine
 from tornado import escape
+from id_generator import id_generator, backdated_id, SEQUENCE_BITS, WORKER_BITS
+
+
+# Claims a unique indexed value for a new record and writes the record in one
+# atomic step. Returns 0 and writes nothing if the value is already taken.
+SAVE_UNIQUE_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('HMSET', KEYS[2], unpack(ARGV, 3))
+return 1
+"""
+
+# Same as SAVE_UNIQUE_SCRIPT for sessions, which also expire at ARGV[3].
+SAVE_SESSION_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('HMSET', KEYS[2], unpack(ARGV, 4))
+redis.call('EXPIREAT', KEYS[2], ARGV[3])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+return 1
+"""
+
+# Reserves ARGV[2k+4] consecutive import indexes for each second k, whose
+# counter is KEYS[k] and whose index 0 has the backdated id ARGV[2k+3].
+# Counters expire after ARGV[2] seconds, so indexes whose message already
+# exists under ARGV[1] are skipped rather than trusted to the counter.
+# Returns the first reserved index of every second.
+RESERVE_IMPORT_INDEXES_SCRIPT = """
+local sequence_size = tonumber(ARGV[3])
+local millisecond_step = tonumber(ARGV[4])
+local starts = {}
+for k, key in ipairs(KEYS) do
+    local base = tonumber(ARGV[2 * k + 3])
+    local count = tonumber(ARGV[2 * k + 4])
+    local start = tonumber(redis.call('GET', key) or 0)
+    local offset = 0
+    while offset < count do
+        local index = start + offset
+        local id = base + math.floor(index / sequence_size) * millisecond_step + index % sequence_size
+        if redis.call('EXISTS', ARGV[1] .. ':' .. string.format('%d', id)) == 1 then
+            start = index + 1
+            offset = 0
+        else
+            offset = offset + 1
+        end
+    end
+    redis.call('SET', key, start + count, 'EX', ARGV[2])
+    starts[k] = start
+end
+return starts
+"""
 
 
 class BaseMapper(object):
@@ -12,27 +65,8 @@ class BaseMapper(object):
         super(BaseMapper, self).__init__()
         self.connection = connection
 
-    @coroutine
-    def acquire_lock(self, name):
-        lock_name = 'lock:{}:{}'.format(self.name, name)
-        lock = self.connection.lock(lock_name, lock_ttl=1)
-        if not lock:
-            return None
-
-        result = yield Task(lock.acquire, blocking=True)
-        if not result:
-            return None
-        return lock
-
-    @coroutine
-    def release_lock(self, lock):
-        yield Task(lock.release)
-
-    @coroutine
     def get_new_id(self):
-        index_key = '{}:id'.format(self.name)
-        _id = yield Task(self.connection.incr, index_key)
-        return _id
+        return id_generator.next_id()
 
     @coroutine
     def save(self, values):
@@ -64,6 +98,15 @@ class BaseMapper(object):
         data = yield Task(pipeline.execute)
         return data
 
+    @coroutine
+    def save_unique(self, values, indexed_value):
+        name_key = '{}s'.format(self.name)
+        model_key = '{}:{}'.format(self.name, values['id'])
+        args = [indexed_value, values['id']] + [i for k, v in values.items() for i in (k, v)]
+        saved = yield Task(self.connection.eval, SAVE_UNIQUE_SCRIPT,
+                           keys=[name_key, model_key], args=args)
+        return bool(saved)
+
     @coroutine
     def set_index_value(self, _id, indexed_value):
         name_key = '{}s'.format(self.name)
@@ -77,7 +120,7 @@ class BaseMapper(object):
 
     @coroutine
     def delete_index(self, indexed_value):
-        index_key = '{}s:'.format(self.name)
+        index_key = '{}s'.format(self.name)
         yield self.connection.hdel(index_key, indexed_value)
 
     @coroutine
@@ -94,9 +137,58 @@ class BaseMapper(object):
 class UserMapper(BaseMapper):
     name = 'user'
 
+    @coroutine
+    def get_names(self, ids):
+        if not ids:
+            return []
+        pipeline = self.connection.pipeline()
+        for _id in ids:
+            pipeline.hget('{}:{}'.format(self.name, _id), 'name')
+        names = yield Task(pipeline.execute)
+        return names
+
 
 class SessionMapper(BaseMapper):
     name = 'session'
+    expires_key = 'sessions:expires'
+
+    @coroutine
+    def save_unique(self, values, indexed_value):
+        name_key = '{}s'.format(self.name)
+        model_key = '{}:{}'.format(self.name, values['id'])
+        args = [indexed_value, values['id'], values['expires']] + \
+            [i for k, v in values.items() for i in (k, v)]
+        saved = yield Task(self.connection.eval, SAVE_SESSION_SCRIPT,
+                           keys=[name_key, model_key, self.expires_key], args=args)
+        return bool(saved)
+
+    @coroutine
+    def renew(self, session):
+        model_key = '{}:{}'.format(self.name, session.id)
+        pipeline = self.connection.pipeline()
+        pipeline.hset(model_key, 'expires', session.expires)
+        pipeline.expireat(model_key, session.expires)
+        pipeline.zadd(self.expires_key, session.expires, session.key)
+        yield Task(pipeline.execute)
+
+    @coroutine
+    def delete_index(self, indexed_value):
+        pipeline = self.connection.pipeline()
+        pipeline.hdel('{}s'.format(self.name), indexed_value)
+        pipeline.zrem(self.expires_key, indexed_value)
+        yield Task(pipeline.execute)
+
+    @coroutine
+    def sweep_expired(self, now, count):
+        keys = yield Task(self.connection.zrangebyscore, self.expires_key,
+                          '-inf', now, offset=0, limit=count, with_scores=False)
+        if not keys:
+            return 0
+        pipeline = self.connection.pipeline(True)
+        pipeline.hdel('{}s'.format(self.name), *keys)
+        pipeline.zrem(self.expires_key, *keys)
+        yield Task(pipeline.execute)
+        return len(keys)
 
 
 class ChannelMapper(BaseMapper):
@@ -104,21 +196,83 @@ class ChannelMapper(BaseMapper):
 
 
 class MessageMapper(BaseMapper):
+    """
+    Messages of a channel are indexed in the sorted set channel:<id>:messages
+    scored by message id, which orders them by time. Messages of a user stay
+    in the plain set user:<id>:messages.
+    """
     name = 'message'
 
     @coroutine
     def get_by_channel(self, channel):
         messages_key = '{0}:{1}:{2}s'.format('channel', channel.id, self.name)
-        message_ids = yield Task(self.connection.smembers, messages_key)
+        message_ids = yield Task(self.connection.zrange, messages_key, 0, -1, with_scores=False)
         messages = yield self.get_many(message_ids)
         return messages
 
+    @coroutine
+    def get_ids_by_channel(self, channel, cursor, before, limit):
+        messages_key = '{0}:{1}:{2}s'.format('channel', channel.id, self.name)
+        start = '({}'.format(cursor) if cursor is not None else '-inf'
+        end = '({}'.format(before) if before is not None else '+inf'
+        message_ids = yield Task(self.connection.zrangebyscore, messages_key, start, end,
+                                 offset=0, limit=limit, with_scores=False)
+        return [int(_id) for _id in message_ids]
+
+    @coroutine
+    def get_last_ids_by_channel(self, channel, limit):
+        messages_key = '{0}:{1}:{2}s'.format('channel', channel.id, self.name)
+        message_ids = yield Task(self.connection.zrange, messages_key, -limit, -1, with_scores=False)
+        return [int(_id) for _id in message_ids]
+
+    @coroutine
+    def save_foreign_keys_relations(self, model, fk_from, fk_to):
+        if fk_from != 'channel':
+            yield super(MessageMapper, self).save_foreign_keys_relations(model, fk_from, fk_to)
+            return
+        model_foreign_key = '{}:{}:{}s'.format(fk_from, model.channel.id, self.name)
+        yield Task(self.connection.zadd, model_foreign_key, model.id, model.id)
+
     @coroutine
     def publish(self, message):
         channel_name = 'sub:channel:{}'.format(message.channel.id)
         yield Task(self.connection.publish, channel=channel_name,
                    message=escape.json_encode(message.get_dict()))
 
+    @coroutine
+    def publish_import(self, channel, count):
+        channel_name = 'sub:channel:{}:imports'.format(channel.id)
+        yield Task(self.connection.publish, channel=channel_name,
+                   message=escape.json_encode({'imported': count, 'channel': channel.id}))
+
+    @coroutine
+    def reserve_import_indexes(self, counts, ttl):
+        seconds = sorted(counts)
+        keys = ['{}:import:index:{}'.format(self.name, second) for second in seconds]
+        args = [self.name, ttl, 1 << SEQUENCE_BITS, 1 << (WORKER_BITS + SEQUENCE_BITS)]
+        for second in seconds:
+            args += [backdated_id(second, 0), counts[second]]
+        starts = yield Task(self.connection.eval, RESERVE_IMPORT_INDEXES_SCRIPT, keys=keys, args=args)
+        return {second: int(start) for second, start in zip(seconds, starts)}
+
+    @coroutine
+    def save_many(self, values_list):
+        relations = {}
+        pipeline = self.connection.pipeline()
+        for values in values_list:
+            pipeline.hmset('{}:{}'.format(self.name, values['id']), values)
+            relations.setdefault(('channel', values['channel']), []).append(values['id'])
+            if values['user'] is not None:
+                relations.setdefault(('user', values['user']), []).append(values['id'])
+        for (fk_from, fk_id), ids in relations.items():
+            key = '{}:{}:{}s'.format(fk_from, fk_id, self.name)
+            if fk_from == 'channel':
+                pipeline.zadd(key, *[i for _id in ids for i in (_id, _id)])
+            else:
+                pipeline.sadd(key, *ids)
+        results = yield Task(pipeline.execute)
+        return not any(isinstance(r, Exception) for r in results)
+
 
 class ChannelUserMapper(BaseMapper):
     name = 'channel_user'
@@ -162,6 +316,14 @@ class ChannelUserMapper(BaseMapper):
         data = yield self.get_many(ids)
         return data
 
+    @coroutine
+    def get_user_ids_by_channel(self, channel, cursor, limit):
+        key = '{}:{}:{}s'.format('channel', channel.id, 'user')
+        start = '({}'.format(cursor) if cursor is not None else '-inf'
+        entries = yield Task(self.connection.zrangebyscore, key, start, '+inf',
+                             offset=0, limit=limit, with_scores=True)
+        return [int(score) for member, score in entries]
+
     @coroutine
     def delete_foreign_keys_relation(self, model, fk_from, fk_to):
         key = '{}:{}:{}s'.format(fk_from, getattr(model, fk_from).id,  fk_to)
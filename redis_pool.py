@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from tornado.gen import coroutine, with_timeout, TimeoutError
+from tornado.concurrent import Future
+from tornadoredis.connection import ConnectionProxy
+from common_exception import CommonException
+from metrics import metrics
+from datetime import timedelta
+import tornadoredis
+
+
+class PoolTimeout(CommonException):
+    pass
+
+
+class PendingConnection(ConnectionProxy):
+    """
+    ConnectionProxy whose `assigned` future resolves once the pool hands it
+    a released connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PendingConnection, self).__init__(*args, **kwargs)
+        self.assigned = Future()
+
+    def assign_connection(self, connection):
+        super(PendingConnection, self).assign_connection(connection)
+        if not self.assigned.done():
+            self.assigned.set_result(connection)
+
+
+class ConnectionPool(tornadoredis.ConnectionPool):
+    """
+    tornadoredis.ConnectionPool with saturation stats and an optional bounded
+    wait for a free connection.
+
+    Every released connection is handed to a single waiting client; a client
+    still waiting after `acquire_timeout` seconds, unless the caller of
+    wait_connection() asks for another deadline, is dropped from the queue.
+    """
+
+    def __init__(self, name, acquire_timeout=None, **kwargs):
+        super(ConnectionPool, self).__init__(**kwargs)
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        for stat in ('in_use', 'available', 'waiting', 'saturated'):
+            metrics.register_gauge('redis.{}_pool.{}'.format(name, stat),
+                                   lambda stat=stat: self.stats()[stat])
+
+    def saturated(self):
+        return not self._available_connections and \
+            self._created_connections >= self.max_connections
+
+    def stats(self):
+        return {
+            'in_use': len(self._in_use_connections),
+            'available': len(self._available_connections),
+            'waiting': len(self._waiting_clients),
+            'saturated': self.saturated(),
+        }
+
+    def make_proxy(self, client_proxy=None, connected=True):
+        connection = PendingConnection(pool=self, client_proxy=client_proxy, connected=connected)
+        if connected:
+            self._waiting_clients.add(connection)
+        return connection
+
+    @coroutine
+    def wait_connection(self, client, acquire_timeout=None):
+        connection = client.connection
+        if not isinstance(connection, PendingConnection):
+            return
+        acquire_timeout = acquire_timeout or self.acquire_timeout
+        if acquire_timeout is None:
+            yield connection.assigned
+            return
+        try:
+            yield with_timeout(timedelta(seconds=acquire_timeout), connection.assigned)
+        except TimeoutError:
+            self.release(connection)
+            metrics.incr('redis.{}_pool.timeouts'.format(self.name))
+            raise PoolTimeout('No {} connection available'.format(self.name))
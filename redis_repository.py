@@ -4,7 +4,10 @@
 from models import BaseModel, Session, User, Channel, ChannelUser, Message
 from redis_mapper import BaseMapper, UserMapper, SessionMapper, ChannelMapper, MessageMapper, ChannelUserMapper
 from common_exception import CommonException
+from id_generator import backdated_id
+from collections import Counter
 from tornado.gen import coroutine
+from time import time
 
 
 class BaseRepository(object):
@@ -35,11 +38,7 @@ class BaseRepository(object):
 
     @coroutine
     def save(self, instance):
-        _id = yield self.mapper.get_new_id()
-        if _id is None:
-            raise CommonException('Save error')
-
-        instance.id = _id
+        instance.id = self.mapper.get_new_id()
         values = self._get_model_attributes(instance)
         yield self.mapper.save(values)
         return instance
@@ -63,20 +62,12 @@ class UserRepository(BaseRepository):
 
     @coroutine
     def save(self, user):
-        lock = yield self.mapper.acquire_lock(user.name)
-        _id = yield self.mapper.get_index_value(user.name)
-        if _id:
-            raise CommonException('Already exist')
-
-        _id = yield self.mapper.get_new_id()
-        if _id is None:
-            raise CommonException('Save error')
-
-        yield self.mapper.set_index_value(_id, user.name)
-        user.id = _id
+        user.id = self.mapper.get_new_id()
         values = self._get_model_attributes(user)
-        yield self.mapper.save(values)
-        yield self.mapper.release_lock(lock)
+        saved = yield self.mapper.save_unique(values, user.name)
+        if not saved:
+            user.id = None
+            raise CommonException('Already exist')
         return user
 
     @coroutine
@@ -92,6 +83,11 @@ class UserRepository(BaseRepository):
             return result
         return None
 
+    @coroutine
+    def get_names(self, ids):
+        names = yield self.mapper.get_names(ids)
+        return dict(zip(ids, names))
+
 
 class SessionRepository(BaseRepository):
     model_attributes = ('id', 'key', 'user', 'expires', 'timezone')
@@ -103,21 +99,13 @@ class SessionRepository(BaseRepository):
 
     @coroutine
     def save(self, session):
-        lock = yield self.mapper.acquire_lock(session.key)
-        _id = yield self.mapper.get_index_value(session.key)
-        if _id:
-            raise CommonException('Already exist')
-
-        _id = yield self.mapper.get_new_id()
-        if _id is None:
-            raise CommonException('Save error')
-
-        yield self.mapper.set_index_value(_id, session.key)
-        session.id = _id
+        session.id = self.mapper.get_new_id()
         values = self._get_model_attributes(session)
         values['user'] = session.user.id
-        yield self.mapper.save(values)
-        yield self.mapper.release_lock(lock)
+        saved = yield self.mapper.save_unique(values, session.key)
+        if not saved:
+            session.id = None
+            raise CommonException('Already exist')
         return session
 
     @coroutine
@@ -125,6 +113,8 @@ class SessionRepository(BaseRepository):
         if 'key' in query:
             _id = yield self.mapper.get_index_value(query.get('key'))
             result = yield self.get_one(_id)
+            if result and result.is_expired():
+                return None
             return result
         return None
 
@@ -133,6 +123,17 @@ class SessionRepository(BaseRepository):
         yield self.mapper.delete(session)
         yield self.mapper.delete_index(session.key)
 
+    @coroutine
+    def renew(self, session, ttl):
+        session.renew(ttl)
+        yield self.mapper.renew(session)
+        return session
+
+    @coroutine
+    def sweep_expired(self, count):
+        swept = yield self.mapper.sweep_expired(int(time()), count)
+        return swept
+
     def _create_model(self, data):
         if not data:
             return None
@@ -158,20 +159,12 @@ class ChannelRepository(BaseRepository):
 
     @coroutine
     def save(self, channel):
-        lock = yield self.mapper.acquire_lock(channel.name)
-        _id = yield self.mapper.get_index_value(channel.name)
-        if _id:
-            raise CommonException('Already exist')
-
-        _id = yield self.mapper.get_new_id()
-        if _id is None:
-            raise CommonException('Save error')
-
-        yield self.mapper.set_index_value(_id, channel.name)
-        channel.id = _id
+        channel.id = self.mapper.get_new_id()
         values = self._get_model_attributes(channel)
-        yield self.mapper.save(values)
-        yield self.mapper.release_lock(lock)
+        saved = yield self.mapper.save_unique(values, channel.name)
+        if not saved:
+            channel.id = None
+            raise CommonException('Already exist')
         return channel
 
     @coroutine
@@ -204,6 +197,28 @@ class MessageRepository(BaseRepository):
             yield self.mapper.save_foreign_keys_relations(message, 'user', 'channel')
         return message
 
+    @coroutine
+    def save_many(self, messages, chunk_size):
+        for start in range(0, len(messages), chunk_size):
+            chunk = messages[start:start + chunk_size]
+            saved = yield self.mapper.save_many([self._get_model_attributes(m) for m in chunk])
+            if not saved:
+                raise CommonException('Save error')
+        return messages
+
+    def assign_id(self, message):
+        message.id = self.mapper.get_new_id()
+        return message
+
+    @coroutine
+    def assign_backdated_ids(self, messages, index_ttl):
+        counts = Counter(m.timestamp for m in messages)
+        indexes = yield self.mapper.reserve_import_indexes(counts, index_ttl)
+        for message in messages:
+            message.id = backdated_id(message.timestamp, indexes[message.timestamp])
+            indexes[message.timestamp] += 1
+        return messages
+
     @coroutine
     def filter(self, query):
         if 'channel' in query:
@@ -212,17 +227,38 @@ class MessageRepository(BaseRepository):
             return [self._create_model(d) for d in data]
         return None
 
+    @coroutine
+    def get_ids(self, query):
+        """
+        Ids of up to query['limit'] messages of query['channel'] in id order,
+        newer than query['cursor'] and older than query['before'] if given.
+        """
+        if 'channel' in query:
+            ids = yield self.mapper.get_ids_by_channel(query['channel'], query.get('cursor'),
+                                                       query.get('before'), query['limit'])
+            return ids
+        return None
+
+    @coroutine
+    def get_last_ids(self, channel, limit):
+        ids = yield self.mapper.get_last_ids_by_channel(channel, limit)
+        return ids
+
     def _create_model(self, data):
-        if data is None:
+        if not data:
             return None
-        data['timestamp'] = int(data['timestamp'])
-        model = self.model(**data)
-        return model
+        user = data.get('user')
+        return self.model.from_values(int(data['id']), user if user != 'None' else None,
+                                      data.get('channel'), data.get('text'), int(data['timestamp']))
 
     @coroutine
     def publish_message(self, message):
         yield self.mapper.publish(message)
 
+    @coroutine
+    def publish_import(self, channel, count):
+        yield self.mapper.publish_import(channel, count)
+
     def _get_model_attributes(self, message):
         result = {}
         for attr in self.model_attributes:
@@ -269,6 +305,12 @@ class ChannelUserRepository(BaseRepository):
 
         return None
 
+    @coroutine
+    def get_member_ids(self, channel, cursor=None, limit=100):
+        user_ids = yield self.mapper.get_user_ids_by_channel(channel, cursor, limit + 1)
+        next_cursor = user_ids[limit - 1] if len(user_ids) > limit else None
+        return user_ids[:limit], next_cursor
+
     @coroutine
     def delete(self, model):
         yield self.mapper.delete_foreign_keys_relation(model, 'channel', 'user')
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from settings import trace_settings
+import tornadoredis
+import logging
+import random
+import re
+import time
+
+
+slow_log = logging.getLogger('chat.slow')
+
+KEY_ID_PATTERN = re.compile(r'(?<=:)\d+(?=:|$)')
+
+
+def key_pattern(key):
+    if key is None:
+        return None
+    return KEY_ID_PATTERN.sub('*', str(key))
+
+
+def command_key(cmd, args):
+    """
+    Key a command operates on: the first KEYS entry for scripts, otherwise
+    the first argument.
+    """
+    if cmd in ('EVAL', 'EVALSHA'):
+        return args[2] if len(args) > 2 and int(args[1]) > 0 else None
+    return args[0] if args else None
+
+
+def is_sampled():
+    if not trace_settings['enabled']:
+        return False
+    return random.random() < trace_settings['sample_rate']
+
+
+class RequestTrace(object):
+    def __init__(self, name):
+        super(RequestTrace, self).__init__()
+        self.name = name
+        self.started = time.time()
+        self.commands = []
+        self.command_count = 0
+        self.redis_time = 0.0
+        self.pool_wait = 0.0
+
+    def record(self, command, key, latency, count=1):
+        self.commands.append((command, key_pattern(key), latency))
+        self.command_count += count
+        self.redis_time += latency
+
+    def record_pool_wait(self, latency):
+        self.pool_wait += latency
+
+    def summary(self):
+        return 'redis: {} commands in {} round trips, {:.2f}ms total, {:.2f}ms pool wait'.format(
+            self.command_count, len(self.commands), self.redis_time * 1000, self.pool_wait * 1000)
+
+    def finish(self, duration=None):
+        if duration is None:
+            duration = time.time() - self.started
+        if duration < trace_settings['slow_threshold']:
+            return
+        lines = ['  {} {} {:.2f}ms'.format(command, key, latency * 1000)
+                 for command, key, latency in self.commands]
+        slow_log.warning('%s %.2fms %s\n%s', self.name, duration * 1000,
+                         self.summary(), '\n'.join(lines))
+
+
+def traced_callback(trace, command, key, callback, count=1):
+    started = time.time()
+
+    def traced(result):
+        trace.record(command, key, time.time() - started, count=count)
+        if callback:
+            callback(result)
+    return traced
+
+
+class TracedClient(tornadoredis.Client):
+    """
+    Client recording every command it sends into the given RequestTrace.
+
+    tornadoredis binds methods by looking them up on the instance class or
+    on Client only, so subclasses have to define every method they rely on
+    themselves.
+    """
+
+    def __init__(self, trace, *args, **kwargs):
+        super(TracedClient, self).__init__(*args, **kwargs)
+        self.trace = trace
+
+    def execute_command(self, cmd, *args, **kwargs):
+        kwargs['callback'] = traced_callback(self.trace, cmd, command_key(cmd, args),
+                                             kwargs.get('callback'))
+        tornadoredis.Client.execute_command(self, cmd, *args, **kwargs)
+
+    def pipeline(self, transactional=False):
+        return TracedPipeline(self.trace, tornadoredis.Client.pipeline(self, transactional))
+
+
+class TracedPipeline(object):
+    """
+    Wraps a tornadoredis Pipeline, recording every execute() as one round
+    trip.
+    """
+
+    def __init__(self, trace, pipeline):
+        super(TracedPipeline, self).__init__()
+        self.trace = trace
+        self.pipeline = pipeline
+
+    def __getattr__(self, item):
+        return getattr(self.pipeline, item)
+
+    def traced_callback(self, callback):
+        command_stack = self.pipeline.command_stack
+        commands = sorted(set(cmd_line.cmd for cmd_line in command_stack))
+        keys = sorted(set(key_pattern(command_key(cmd_line.cmd, cmd_line.args))
+                          for cmd_line in command_stack if cmd_line.args) - {None})
+        return traced_callback(self.trace, 'PIPELINE({})'.format(' '.join(commands)),
+                               ','.join(keys), callback, count=len(command_stack))
+
+    def execute(self, callback=None):
+        self.pipeline.execute(callback=self.traced_callback(callback))
@@ -22,5 +22,89 @@ db_settings = {
 
 db_pool_settings = {
     'max_connections': 100,
-    'wait_for_available': True
+    'wait_for_available': True,
+    'acquire_timeout': 1.0,
+}
+
+websocket_settings = {
+    # established sessions wait longer for a command connection than new requests
+    'message_acquire_timeout': 10.0,
+}
+
+subscribe_pool_settings = {
+    'max_connections': 5000,
+    'wait_for_available': False,
+}
+
+loop_monitor_settings = {
+    'interval': 0.1,
+    'shed_connect_lag': 0.1,
+    'shed_request_lag': 0.25,
+    'shed_samples': 3,
+    'retry_after': 5,
+}
+
+id_settings = {
+    'worker_id': 0,
+    'lease_ttl': 30,
+    'lease_refresh_interval': 10,
+}
+
+session_settings = {
+    'ttl': 24 * 60 * 60,
+    'sliding': False,
+    'renew_threshold': 12 * 60 * 60,
+    'sweep_interval': 10,
+    'sweep_batch': 500,
+}
+
+trace_settings = {
+    'enabled': False,
+    'sample_rate': 0.1,
+    'slow_threshold': 0.5,
+}
+
+history_settings = {
+    'stream_batch_size': 500,
+}
+
+history_cache_settings = {
+    'capacity': 200,
+    'memory_budget': 32 * 1024 * 1024,
+    'idle_timeout': 10 * 60,
+}
+
+bulk_settings = {
+    'max_batch': 10000,
+    'chunk_size': 500,
+    'index_ttl': 60 * 60,
+}
+
+write_behind_settings = {
+    'enabled': False,
+    'max_size': 20000,
+    'flush_size': 500,
+    'flush_interval': 0.05,
+}
+
+metrics_settings = {
+    'allowed_ips': ['127.0.0.1', '::1'],
+}
+
+members_settings = {
+    'page_size': 100,
+    'max_page_size': 1000,
+}
+
+production_settings = {
+    'debug': False,
+    'autoreload': False,
+    'server_traceback': False,
+    'compiled_template_cache': True,
+    'static_hash_cache': True,
+}
+
+static_settings = {
+    'gzip_min_size': 256,
+    'max_age': 365 * 24 * 60 * 60,
 }
@@ -104,19 +104,39 @@ var InitMessageHistory = function(channel_id){
     message_list.innerHTML = ""
 
     var xhr = new XMLHttpRequest();
-    xhr.open("GET", '/channel/' + channel_id, true);
+    var offset = 0;
+    var render_chunks = function(){
+        var text = xhr.responseText;
+        var end = text.lastIndexOf('\n');
+        if (end < offset){
+            return;
+        }
+        var lines = text.substring(offset, end).split('\n');
+        offset = end + 1;
+        var content = '';
+        var i = 0;
+        for (i; i < lines.length; i++){
+            if (lines[i].length == 0){
+                continue;
+            }
+            var data = JSON.parse(lines[i]);
+            var j = 0;
+            for (j; j < data.messages.length; j++){
+                content += CreateMessage(data.messages[j]);
+            }
+        }
+        var message_list = document.getElementById('message-list');
+        message_list.insertAdjacentHTML('beforeend', content);
+        message_list.scrollTop = message_list.scrollHeight;
+    };
+    xhr.open("GET", '/channel/' + channel_id + '?stream=1', true);
+    xhr.onprogress = render_chunks;
     xhr.onreadystatechange = function(){
     	var status;
-		var data;
-		var i = 0;
 		if (xhr.readyState == 4) {
 			status = xhr.status;
 			if (status == 200) {
-				data = JSON.parse(xhr.responseText);
-				var message_list = document.getElementById('message-list');
-				for (i; i < data.messages.length; i++){
-                    message_list.innerHTML += CreateMessage(data.messages[i])
-				}
+				render_chunks();
 			} else {
 				alert('Something went wrong.');
 			}
@@ -143,19 +163,53 @@ var RegisterSockethandler = function(channel_id) {
 
 var SocketHandler = function(channel_id) {
     var url = "ws://" + location.host + "/chatsocket/" + channel_id;
+    var retry_delay = 1000;
+    var opened_at = null;
+    clearTimeout(window.socket_retry);
     if (window.socket){
         window.socket.close()
     }
-    window.socket = new WebSocket(url);
-    window.socket.onmessage = function(event){
-        var message = JSON.parse(event.data);
-        var message_list = document.getElementById('message-list');
-        message_list.innerHTML += CreateMessage(message)
-        message_list.scrollTop = message_list.scrollHeight;
-    };
 
-    window.socket.onclose = function(event){
+    var connect = function(){
+        var socket = new WebSocket(url);
+        window.socket = socket;
+        socket.onopen = function(){
+            opened_at = Date.now();
+        };
+        socket.onmessage = function(event){
+            var message = JSON.parse(event.data);
+            if (message.imported !== undefined){
+                InitMessageHistory(channel_id);
+                return;
+            }
+            var message_list = document.getElementById('message-list');
+            if (message.error !== undefined){
+                var input = document.querySelector("#message-form input[type=text]");
+                if (!input.value){
+                    input.value = message.text;
+                }
+                message_list.innerHTML += '<div class="card-block border rounded text-wrap p-2 my-1">'
+                    + '<p class="font-weight-bold">' + message.error + '</p></div>';
+                message_list.scrollTop = message_list.scrollHeight;
+                return;
+            }
+            message_list.innerHTML += CreateMessage(message)
+            message_list.scrollTop = message_list.scrollHeight;
+        };
+        // 1006: connection lost or upgrade refused, 1013: server overloaded
+        socket.onclose = function(event){
+            if (window.socket !== socket || (event.code != 1006 && event.code != 1013)){
+                return;
+            }
+            if (opened_at && Date.now() - opened_at > 30000){
+                retry_delay = 1000;
+            }
+            opened_at = null;
+            window.socket_retry = setTimeout(connect, retry_delay / 2 + Math.random() * retry_delay);
+            retry_delay = Math.min(retry_delay * 2, 30000);
+        };
     };
+    connect();
 
     this.send_message = function(form){
         var elements = form.elements;
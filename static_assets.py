@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from tornado.web import RequestHandler, HTTPError
+from settings import static_settings
+import gzip
+import hashlib
+import mimetypes
+import os
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class Asset(object):
+    __slots__ = ('path', 'versioned_path', 'content_type', 'data', 'gzip_data', 'version')
+
+    def __init__(self, path, data):
+        super(Asset, self).__init__()
+        self.path = path
+        self.data = data
+        self.version = hashlib.md5(data).hexdigest()[:12]
+        name, ext = os.path.splitext(path)
+        self.versioned_path = '{}.{}{}'.format(name, self.version, ext)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.gzip_data = None
+        if len(data) >= static_settings['gzip_min_size'] and \
+                self.content_type.startswith(COMPRESSIBLE_TYPES):
+            gzip_data = gzip.compress(data, 9)
+            if len(gzip_data) < len(data):
+                self.gzip_data = gzip_data
+
+
+class AssetManifest(object):
+    def __init__(self, static_path):
+        super(AssetManifest, self).__init__()
+        self.static_path = static_path
+        self.assets = {}
+        self.versioned = {}
+
+    def build(self):
+        for root, dirs, files in os.walk(self.static_path):
+            for file_name in files:
+                absolute_path = os.path.join(root, file_name)
+                path = os.path.relpath(absolute_path, self.static_path).replace(os.sep, '/')
+                with open(absolute_path, 'rb') as f:
+                    asset = Asset(path, f.read())
+                self.assets[path] = asset
+                self.versioned[asset.versioned_path] = asset
+        return self
+
+    def url_path(self, path):
+        asset = self.assets.get(path)
+        if not asset:
+            return path
+        return asset.versioned_path
+
+    def lookup(self, url_path):
+        asset = self.versioned.get(url_path)
+        if asset:
+            return asset, True
+        return self.assets.get(url_path), False
+
+
+class AssetHandler(RequestHandler):
+    """
+    Serves files from an AssetManifest built at startup.
+
+    URLs produced by static_url() carry a content hash in the file name and
+    are cached forever; gzip variants are compressed once, not per request.
+    """
+    manifest = None
+
+    @classmethod
+    def build_manifest(cls, static_path):
+        cls.manifest = AssetManifest(static_path).build()
+
+    def initialize(self, path, default_filename=None):
+        self.asset = None
+        self.use_gzip = False
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        url_path = cls.manifest.url_path(path) if cls.manifest and include_version else path
+        return settings.get('static_url_prefix', '/static/') + url_path
+
+    def head(self, path):
+        return self.get(path, include_body=False)
+
+    def get(self, path, include_body=True):
+        asset, versioned = self.manifest.lookup(path)
+        if not asset:
+            raise HTTPError(404)
+        self.asset = asset
+        self.use_gzip = asset.gzip_data is not None and \
+            'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+        self.set_header('Content-Type', asset.content_type)
+        self.set_header('Vary', 'Accept-Encoding')
+        if versioned:
+            self.set_header('Cache-Control', 'public, max-age={}, immutable'.format(
+                static_settings['max_age']))
+        else:
+            self.set_header('Cache-Control', 'public, no-cache')
+        data = asset.data
+        if self.use_gzip:
+            self.set_header('Content-Encoding', 'gzip')
+            data = asset.gzip_data
+        if include_body:
+            self.write(data)
+        else:
+            self.set_header('Content-Length', len(data))
+
+    def compute_etag(self):
+        if not self.asset:
+            return None
+        return '"{}{}"'.format(self.asset.version, '-gzip' if self.use_gzip else '')
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from tornado.gen import coroutine, Task
+from tornado.ioloop import PeriodicCallback
+from tornado.log import app_log
+import os
+import socket
+import uuid
+
+
+# Extends the lease held by ARGV[1] for ARGV[2] seconds, claiming it again if
+# it expired meanwhile. Returns 0 if another process holds it.
+REFRESH_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# Deletes the lease only if ARGV[1] still holds it.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class WorkerLease(object):
+    """
+    Lease on a worker id in Redis, so that two processes started with the
+    same worker id do not generate colliding ids.
+
+    The lease expires after `ttl` seconds and is refreshed every
+    `refresh_interval` seconds. When another process turns out to hold it,
+    on_lost() is called and ids must not be generated any more.
+    """
+
+    def __init__(self, get_connection, worker_id, ttl, refresh_interval):
+        super(WorkerLease, self).__init__()
+        self.get_connection = get_connection
+        self.key = 'chat:worker:{}'.format(worker_id)
+        self.token = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.holder = None
+        self.on_lost = None
+        self.periodic_refresh = None
+
+    def start(self, on_lost):
+        self.on_lost = on_lost
+        self.periodic_refresh = PeriodicCallback(self.refresh, self.refresh_interval * 1000)
+        self.periodic_refresh.start()
+
+    @coroutine
+    def acquire(self):
+        db_connection = self.get_connection()
+        try:
+            acquired = yield Task(db_connection.set, self.key, self.token, expire=self.ttl,
+                                  only_if_not_exists=True)
+            if not acquired:
+                self.holder = yield Task(db_connection.get, self.key)
+        finally:
+            yield Task(db_connection.disconnect)
+        return bool(acquired)
+
+    @coroutine
+    def refresh(self):
+        db_connection = self.get_connection()
+        try:
+            held = yield Task(db_connection.eval, REFRESH_SCRIPT, keys=[self.key], args=[self.token, self.ttl])
+        except Exception:
+            app_log.exception('Failed to refresh %s', self.key)
+            return
+        finally:
+            yield Task(db_connection.disconnect)
+        if not held:
+            app_log.error('%s is held by another process, shutting down', self.key)
+            self.periodic_refresh.stop()
+            self.on_lost()
+
+    @coroutine
+    def release(self):
+        if self.periodic_refresh:
+            self.periodic_refresh.stop()
+        db_connection = self.get_connection()
+        try:
+            yield Task(db_connection.eval, RELEASE_SCRIPT, keys=[self.key], args=[self.token])
+        finally:
+            yield Task(db_connection.disconnect)
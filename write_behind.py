@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from tornado.gen import coroutine, Task
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Lock
+from tornado.log import app_log
+from collections import deque
+from redis_repository import MessageRepository
+from metrics import metrics
+import time
+
+
+class MessageWriteQueue(object):
+    """
+    In-process queue of published chat messages waiting to be persisted.
+
+    Messages are written in batches of `flush_size` with
+    MessageRepository.save_many, either when that many are pending or every
+    `flush_interval` seconds. When `max_size` messages are pending, enqueue()
+    refuses new ones and the caller has to save synchronously.
+    """
+
+    def __init__(self, get_connection, max_size, flush_size, flush_interval):
+        super(MessageWriteQueue, self).__init__()
+        self.get_connection = get_connection
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self.lock = Lock()
+        self.periodic_flush = None
+        metrics.register_gauge('write_behind.pending', lambda: len(self.pending))
+        metrics.register_gauge('write_behind.lag_ms', self.lag_ms)
+
+    def start(self):
+        self.periodic_flush = PeriodicCallback(self.flush, self.flush_interval * 1000)
+        self.periodic_flush.start()
+
+    def lag_ms(self):
+        if not self.pending:
+            return 0
+        return round((time.time() - self.pending[0][0]) * 1000, 2)
+
+    def enqueue(self, message):
+        if len(self.pending) >= self.max_size:
+            metrics.incr('write_behind.rejected')
+            return False
+        self.pending.append((time.time(), message))
+        metrics.incr('write_behind.enqueued')
+        if len(self.pending) == self.flush_size:
+            IOLoop.current().add_callback(self.flush)
+        return True
+
+    @coroutine
+    def flush(self):
+        with (yield self.lock.acquire()):
+            while self.pending:
+                batch = [self.pending.popleft() for _ in range(min(self.flush_size, len(self.pending)))]
+                db_connection = self.get_connection()
+                try:
+                    yield MessageRepository(db_connection).save_many([m for _, m in batch], self.flush_size)
+                except Exception:
+                    app_log.exception('Failed to persist %d messages', len(batch))
+                    metrics.incr('write_behind.failed')
+                    self.pending.extendleft(reversed(batch))
+                    return False
+                finally:
+                    yield Task(db_connection.disconnect)
+                metrics.incr('write_behind.flushed', len(batch))
+        return True
+
+    @coroutine
+    def drain(self):
+        flushed = yield self.flush()
+        if not flushed:
+            app_log.error('%d messages were not persisted on shutdown', len(self.pending))